@@ -1,20 +1,27 @@
 import os
+import asyncio
 import secrets
 import json
-import requests
+import hashlib
+import httpx
+from collections import deque
+from functools import lru_cache
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from fastapi import FastAPI, HTTPException, Header
+from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
 
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from supabase_client import supabase
+from supabase_client import get_supabase
 from gotrue.types import UserAttributes
 
 # Lightweight transformer setup
 from transformers import AutoTokenizer, AutoModel
+import numpy as np
 import torch
 import weaviate
 
@@ -25,9 +32,45 @@ load_dotenv()
 WEAVIATE_URL = os.getenv("WEAVIATE_URL")
 WEAVIATE_API_KEY = os.getenv("WEAVIATE_API_KEY")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+# Optional cap on torch's intra-op threads per forward pass; unset keeps
+# torch's default
+TORCH_NUM_THREADS = os.getenv("TORCH_NUM_THREADS")
+# Opt-in int8 quantization of the embedding model; off by default because the
+# stored job vectors were computed with FP32 weights
+QUANTIZE_EMBEDDINGS = os.getenv("QUANTIZE_EMBEDDINGS", "").lower() in ("1", "true", "yes")
+# Cosine similarity above which an earlier reply in the same conversation is
+# reused; unset disables the semantic reply cache
+SEMANTIC_CACHE_THRESHOLD = os.getenv("SEMANTIC_CACHE_THRESHOLD")
+
+# --- Lifespan ---
+# The embedding model, Weaviate connection and OpenRouter HTTP client are
+# created once when the server starts (not at import) and closed on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Missing Supabase credentials stop startup instead of failing per request
+    get_supabase()
+    app.state.tokenizer, app.state.model = load_embedding_model()
+    # Cached embeddings belong to the model they were computed with
+    _embed_cached.cache_clear()
+    app.state.weaviate = weaviate.connect_to_weaviate_cloud(
+        cluster_url=WEAVIATE_URL,
+        auth_credentials=weaviate.auth.AuthApiKey(WEAVIATE_API_KEY),
+        skip_init_checks=True
+    )
+    app.state.collection = app.state.weaviate.collections.get("JobDescription")
+    # Async so LLM calls don't block the event loop; connections to OpenRouter
+    # are kept alive and reused across requests
+    app.state.http_client = httpx.AsyncClient(
+        timeout=60,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=10)
+    )
+    yield
+    app.state.weaviate.close()
+    await app.state.http_client.aclose()
+    _embed_cached.cache_clear()
 
 # --- FastAPI App ---
-app = FastAPI(title="Job Desc AI API - Final Backend", version="5.0.5")
+app = FastAPI(title="Job Desc AI API - Final Backend", version="5.0.5", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -36,6 +79,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- LLM Cache ---
+# Completed LLM replies keyed by sha256 of the prompt, kept for an hour
+LLM_CACHE_TTL = 3600
+llm_cache = TTLCache(maxsize=10_000, ttl=LLM_CACHE_TTL)
+
 # --- Email Config ---
 conf = ConnectionConfig(
     MAIL_USERNAME=os.getenv("MAIL_USERNAME"),
@@ -97,32 +145,152 @@ async def send_custom_email(to_email: str, subject: str, link: str):
 # --- Auth Helpers ---
 def get_user_from_token(token: str):
     try:
-        user_response = supabase.auth.get_user(token)
+        user_response = get_supabase().auth.get_user(token)
         return user_response.user
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid token: {e}")
 
-# --- Lightweight Embedding Model Setup ---
-tokenizer = AutoTokenizer.from_pretrained("intfloat/e5-small", trust_remote_code=True)
-model = AutoModel.from_pretrained("intfloat/e5-small", trust_remote_code=True)
+def as_user(token: str):
+    # The shared client carries one user's JWT at a time and other requests
+    # can replace it while a handler is awaiting. Point Postgrest at this
+    # request's token right before the query, with no await in between.
+    supabase = get_supabase()
+    supabase.postgrest.auth(token)
+    return supabase
+
+# --- LLM Helper ---
+# Static instructions go first as a system message so the prefix is identical
+# across requests and can be reused by provider-side prompt caching
+SYSTEM_PROMPT = """You are JobDesk, a friendly career assistant.
+
+Instructions:
+- If the user is just greeting you, respond with a friendly greeting and ask how you can help with their job search.
+- If the user asks about jobs/careers, use the job descriptions provided to help.
+- Keep responses concise and relevant to what the user actually asked."""
+
+LLM_FALLBACK_REPLY = "⚠️ Error: Could not generate response at the moment."
+
+async def ask_llm(http_client: httpx.AsyncClient, prompt: str) -> Optional[str]:
+    # Returns None when no reply could be generated; callers choose the fallback
+    cache_key = hashlib.sha256(prompt.encode()).hexdigest()
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        response = await http_client.post(
+            "https://openrouter.ai/api/v1/chat/completions",
+            headers={
+                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": "mistralai/mistral-7b-instruct",
+                "messages": [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                "temperature": 0.4
+            }
+        )
+        if response.status_code != 200:
+            print(f"LLM error: HTTP {response.status_code}")
+            return None
+        reply = response.json()["choices"][0]["message"]["content"]
+    except Exception as e:
+        print(f"LLM error: {e}")
+        return None
+    llm_cache[cache_key] = reply
+    return reply
 
-def get_embedding(text: str):
+def format_job(props: dict) -> str:
+    return f"""
+Role: {props['role']}
+Experience: {props['experience']}
+Technical Skills: {', '.join(props['technicalSkills'])}
+Soft Skills: {', '.join(props['softSkills'])}
+Responsibilities: {', '.join(props['responsibilities'])}
+Tools: {', '.join(props['tools'])}
+Education: {props['education']}
+Industry: {props['industry']}
+---
+"""
+
+def build_prompt(user_message: str, jobs) -> str:
+    context = "".join(format_job(obj.properties) for obj in jobs)
+    return f"""
+User Message: {user_message}
+
+{context if context.strip() else "No specific job context needed for this query."}
+"""
+
+# --- Semantic Reply Cache ---
+# Recent (embedding, reply) pairs per conversation, only used when
+# SEMANTIC_CACHE_THRESHOLD is set. e5 similarities sit in a narrow high band,
+# so questions differing only in the role can score very close; calibrate the
+# threshold on real paraphrase / non-paraphrase pairs before enabling it.
+# Embeddings are unit-length, so a dot product is the cosine similarity.
+# A conversation's entries are dropped together LLM_CACHE_TTL after its first
+# one; at most 1,000 conversations x 20 entries are held per worker.
+recent_replies = TTLCache(maxsize=1_000, ttl=LLM_CACHE_TTL)
+
+def find_similar_reply(user_id: str, conversation_id: str, vector: List[float]) -> Optional[str]:
+    if not SEMANTIC_CACHE_THRESHOLD:
+        return None
+    entries = recent_replies.get((user_id, conversation_id))
+    if not entries:
+        return None
+    scores = np.array([v for v, _ in entries]) @ np.asarray(vector, dtype=np.float32)
+    best = int(scores.argmax())
+    return entries[best][1] if scores[best] >= float(SEMANTIC_CACHE_THRESHOLD) else None
+
+def remember_reply(user_id: str, conversation_id: str, vector: List[float], reply: str):
+    if not SEMANTIC_CACHE_THRESHOLD:
+        return
+    key = (user_id, conversation_id)
+    entries = recent_replies.get(key)
+    if entries is None:
+        # Only inserting the deque sets the expiry; appends don't extend it
+        entries = recent_replies[key] = deque(maxlen=20)
+    entries.append((np.asarray(vector, dtype=np.float32), reply))
+
+# --- Lightweight Embedding Model Setup ---
+def load_embedding_model():
+    tokenizer = AutoTokenizer.from_pretrained("intfloat/e5-small", trust_remote_code=True)
+    model = AutoModel.from_pretrained("intfloat/e5-small", trust_remote_code=True).eval()
+    if TORCH_NUM_THREADS:
+        torch.set_num_threads(int(TORCH_NUM_THREADS))
+    if QUANTIZE_EMBEDDINGS:
+        # int8 weights for the Linear layers (the bulk of the compute) on CPU
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return tokenizer, model
+
+@lru_cache(maxsize=4096)
+def _embed_cached(tokenizer, model, text: str) -> tuple:
     inputs = tokenizer(f"query: {text}", return_tensors="pt", truncation=True, padding=True)
-    with torch.no_grad():
-        model_output = model(**inputs)
-    embeddings = model_output.last_hidden_state.mean(dim=1)
-    return embeddings[0].tolist()
-
-# --- Weaviate Client Setup ---
-weaviate_client = weaviate.connect_to_weaviate_cloud(
-    cluster_url=WEAVIATE_URL,
-    auth_credentials=weaviate.auth.AuthApiKey(WEAVIATE_API_KEY)
-)
-collection = weaviate_client.collections.get("JobDescription")
+    with torch.inference_mode():
+        hidden = model(**inputs).last_hidden_state
+        # Mean-pool over real tokens only, then L2-normalize
+        mask = inputs["attention_mask"].unsqueeze(-1).float()
+        embeddings = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+    return tuple(embeddings[0].tolist())
+
+def get_embedding(tokenizer, model, text: str):
+    # Repeated messages ("hi", duplicate questions) skip the transformer entirely
+    return list(_embed_cached(tokenizer, model, text.strip()))
+
+# --- Weaviate Query Setup ---
+# Only the fields used to build the LLM context are fetched per search
+JOB_CONTEXT_PROPERTIES = [
+    "role", "experience", "technicalSkills", "softSkills",
+    "responsibilities", "tools", "education", "industry",
+]
 
 # --- Auth Routes ---
 @app.post("/signup")
 async def signup(credentials: UserCredentials):
+    supabase = get_supabase()
     try:
         supabase.auth.admin.create_user({
             "email": credentials.email,
@@ -139,6 +307,7 @@ async def signup(credentials: UserCredentials):
 
 @app.post("/login", tags=["Authentication"])
 async def login(credentials: UserCredentials):
+    supabase = get_supabase()
     try:
         response = supabase.auth.sign_in_with_password({
             "email": credentials.email,
@@ -150,6 +319,7 @@ async def login(credentials: UserCredentials):
 
 @app.post("/reset-password", tags=["Authentication"])
 async def request_password_reset(body: EmailBody):
+    supabase = get_supabase()
     try:
         list_users_response = supabase.auth.admin.list_users()
         user = next((u for u in list_users_response if u.email == body.email), None)
@@ -177,6 +347,7 @@ async def request_password_reset(body: EmailBody):
 
 @app.post("/update-password", tags=["Authentication"])
 async def update_password_with_token(credentials: UpdatePasswordWithToken):
+    supabase = get_supabase()
     try:
         response = supabase.table("password_reset_tokens").select("*").eq("token", credentials.token).single().execute()
         token_data = response.data
@@ -212,8 +383,8 @@ async def get_conversations(authorization: Optional[str] = Header(None)):
         raise HTTPException(status_code=401, detail="Authorization header missing")
     token = authorization.split(" ")[-1]
     user = get_user_from_token(token)
+    supabase = as_user(token)
     try:
-        supabase.auth.set_session(access_token=token, refresh_token="dummy")
         response = supabase.table("conversations").select("id, title, created_at").eq("user_id", user.id).order("created_at", desc=True).execute()
         return response.data
     except Exception as e:
@@ -225,8 +396,8 @@ async def create_conversation(new_convo: NewConversation, authorization: Optiona
         raise HTTPException(status_code=401, detail="Authorization header missing")
     token = authorization.split(" ")[-1]
     user = get_user_from_token(token)
+    supabase = as_user(token)
     try:
-        supabase.auth.set_session(access_token=token, refresh_token="dummy")
         response = supabase.table("conversations").insert({"user_id": user.id, "title": new_convo.title}).execute()
         return response.data[0]
     except Exception as e:
@@ -238,8 +409,8 @@ async def get_messages(conversation_id: str, authorization: Optional[str] = Head
         raise HTTPException(status_code=401, detail="Authorization header missing")
     token = authorization.split(" ")[-1]
     user = get_user_from_token(token)
+    supabase = as_user(token)
     try:
-        supabase.auth.set_session(access_token=token, refresh_token="dummy")
         check = supabase.table("conversations").select("id").eq("id", conversation_id).eq("user_id", user.id).single().execute()
         if not check.data:
             raise HTTPException(status_code=404, detail="Conversation not found or access denied.")
@@ -249,78 +420,39 @@ async def get_messages(conversation_id: str, authorization: Optional[str] = Head
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
 @app.post("/conversations/{conversation_id}/messages", tags=["Conversations"], response_model=Message)
-async def add_message(conversation_id: str, new_message: NewMessage, authorization: Optional[str] = Header(None)):
+async def add_message(conversation_id: str, new_message: NewMessage, request: Request, authorization: Optional[str] = Header(None)):
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization header missing")
     token = authorization.split(" ")[-1]
     user = get_user_from_token(token)
-    supabase.auth.set_session(access_token=token, refresh_token="dummy")
+    supabase = as_user(token)
 
     owner_check = supabase.table("conversations").select("id").eq("id", conversation_id).eq("user_id", user.id).single().execute()
     if not owner_check.data:
         raise HTTPException(status_code=404, detail="Conversation not found or access denied.")
 
+    # Saved before any await so it runs under the token bound above
     try:
         supabase.table("messages").insert({"conversation_id": conversation_id, "role": "user", "content": new_message.content}).execute()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save user message: {e}")
 
-    vector = get_embedding(new_message.content)
-    results = collection.query.near_vector(near_vector=vector, limit=3)
-
-    context = ""
-    for obj in results.objects:
-        props = obj.properties
-        context += f"""
-Role: {props['role']}
-Experience: {props['experience']}
-Technical Skills: {', '.join(props['technicalSkills'])}
-Soft Skills: {', '.join(props['softSkills'])}
-Responsibilities: {', '.join(props['responsibilities'])}
-Tools: {', '.join(props['tools'])}
-Education: {props['education']}
-Industry: {props['industry']}
----
-"""
-
-    prompt = f"""
-You are JobDesk, a friendly career assistant.
-
-User Message: {new_message.content}
-
-Instructions:
-- If the user is just greeting you, respond with a friendly greeting and ask how you can help with their job search.
-- If the user asks about jobs/careers, use the job descriptions below to help.
-- Keep responses concise and relevant to what the user actually asked.
-
-{context if context.strip() else "No specific job context needed for this query."}
-
-Response:
-"""
-
-    try:
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": "mistralai/mistral-7b-instruct",
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.4
-            }
+    state = request.app.state
+    vector = await asyncio.to_thread(get_embedding, state.tokenizer, state.model, new_message.content)
+    # A near-duplicate of something this user already asked skips search + LLM
+    reply = find_similar_reply(user.id, conversation_id, vector)
+    if reply is None:
+        results = await asyncio.to_thread(
+            lambda: state.collection.query.near_vector(near_vector=vector, limit=3, return_properties=JOB_CONTEXT_PROPERTIES)
         )
-        if response.status_code == 200:
-            reply = response.json()["choices"][0]["message"]["content"]
+        reply = await ask_llm(state.http_client, build_prompt(new_message.content, results.objects))
+        if reply is None:
+            reply = LLM_FALLBACK_REPLY
         else:
-            reply = "⚠️ Error: Could not fetch response from LLM."
-    except Exception as e:
-        print(f"LLM error: {e}")
-        reply = "⚠️ Error: Could not generate response at the moment."
+            remember_reply(user.id, conversation_id, vector, reply)
 
     try:
-        ai_response = supabase.table("messages").insert({"conversation_id": conversation_id, "role": "assistant", "content": reply}).execute()
+        ai_response = as_user(token).table("messages").insert({"conversation_id": conversation_id, "role": "assistant", "content": reply}).execute()
         return ai_response.data[0]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save AI message: {e}")
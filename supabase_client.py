@@ -1,5 +1,6 @@
 import os
-from supabase import create_client, Client
+from functools import lru_cache
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 
 # --- Step 1: Load Environment Variables ---
@@ -9,22 +10,23 @@ load_dotenv()
 
 # --- Step 2: Get Supabase Credentials ---
 # We safely retrieve the URL and Key from the loaded environment variables.
-# os.environ.get() will return None if the variable is not found,
-# preventing the app from crashing.
+# os.environ.get() will return None if the variable is not found; this is
+# checked when the client is first requested below.
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
 
-# --- Step 3: Initialize the Supabase Client ---
-# We initialize the client outside of the request/response cycle so it can be
-# reused across the application.
-supabase: Client = None # Define the variable with a default value
-
-# A try-except block is used for robustness. If the URL or key is missing,
-# create_client will raise an error.
-try:
-    if url and key:
-        supabase = create_client(url, key)
-    else:
-        print("Error: SUPABASE_URL and SUPABASE_KEY must be set in your .env file.")
-except Exception as e:
-    print(f"Error creating Supabase client: {e}")
\ No newline at end of file
+# --- Step 3: Initialize the Supabase Client Lazily ---
+# The client is created on the first call rather than at import, and
+# lru_cache makes every later call return that same instance. Missing
+# credentials raise a clear error instead of handing callers a None client.
+@lru_cache(maxsize=1)
+def get_supabase() -> Client:
+    if not url or not key:
+        raise RuntimeError("SUPABASE_URL and SUPABASE_KEY must be set in your .env file.")
+    # Bound how long a stalled Postgrest query can hold a request (the
+    # library default is 120 s). Handlers bind the caller's JWT with
+    # postgrest.auth() rather than set_session(), so the Postgrest HTTP client
+    # is kept across requests; a sign-in (/login, /signup) still makes
+    # supabase-py replace it.
+    options = ClientOptions(postgrest_client_timeout=30)
+    return create_client(url, key, options=options)